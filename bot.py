@@ -1,15 +1,35 @@
+import atexit
 import os
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from telegram.error import BadRequest
 import aiohttp
-import json
+import msgpack
+import numpy as np
+import orjson
+import sqlite3
+from collections import Counter, OrderedDict, deque
 from datetime import datetime, timedelta
 import asyncio
+import logging
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import islice
+from cachetools import TTLCache
 import random
+import re
+import sys
 import time
 
+try:
+    import uvloop  # Faster event loop; not available on Windows
+except ImportError:
+    uvloop = None
+
+log = logging.getLogger('solpaper')
+log.addHandler(logging.NullHandler())  # Silent unless main() configures logging
+
 # Paper trading portfolio
 portfolios = {}
 # Price alerts
@@ -21,12 +41,235 @@ user_settings = {}
 # User Stats (Analytics)
 user_stats = {}
 
+DEFAULT_DATABASE_URL = 'sqlite:///paper_trading.db'
+# Solana addresses are base58 (no 0, O, I or l), 32-44 characters
+ADDRESS_RE = re.compile(r'[1-9A-HJ-NP-Za-km-z]{32,44}')
+# Price API endpoints and headers (token-specific URLs are built per request)
+SOL_MINT = 'So11111111111111111111111111111111111111112'  # Wrapped SOL
+SOL_JUP_URL = 'https://price.jup.ag/v4/price?ids=SOL'
+SOL_DEX_URL = f'https://api.dexscreener.com/latest/dex/tokens/{SOL_MINT}'
+PUMP_HEADERS = {"User-Agent": "Mozilla/5.0"}  # User-Agent is often required
+BIRDEYE_HEADERS = {"X-API-KEY": "public"}  # Public endpoint
+
+DAY_MS = 86_400_000  # Activity timestamps are epoch milliseconds
+SAVE_DELAY = 0.5  # Seconds to coalesce changes before writing them
+SAVE_RETRY_MAX = 60  # Longest wait between retries while saving keeps failing
+SOL_PRICE_TTL = 30  # Seconds the shared SOL price is reused across lookups
+DEFAULT_PRICE_CACHE_TTL = 5  # Seconds a token lookup is reused; PRICE_CACHE_TTL in .env overrides
+RENDER_CACHE_TTL = 3  # Seconds a rendered portfolio view is reused
+# Numbers from the numpy fill path (apply_slippage_batch) are written as plain JSON numbers
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY
+DEFAULT_HISTORY_LIMIT = 1000  # Trades kept in memory per user (the trades table keeps all); HISTORY_LIMIT in .env overrides
+# Legacy flat-file stores, imported into the database on first run
+LEGACY_DATA_FILES = ('paper_trading_data.msgpack', 'paper_trading_data.json')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS portfolios (
+    user_id INTEGER PRIMARY KEY,
+    balance REAL NOT NULL,
+    positions TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trades (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    trade TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trades_user_id ON trades (user_id);
+CREATE TABLE IF NOT EXISTS watchlists (
+    user_id INTEGER NOT NULL,
+    token TEXT NOT NULL,
+    PRIMARY KEY (user_id, token)
+);
+CREATE TABLE IF NOT EXISTS user_settings (
+    user_id INTEGER PRIMARY KEY,
+    settings TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id INTEGER PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+"""
+
+# /start help text, built once; only the balance varies
+START_TEMPLATE = (
+    "🤖 *Solana Memecoin Paper Trading Bot*\n\n"
+    "💰 Balance: {balance:.4f} SOL\n\n"
+    "*Trading Commands:*\n"
+    "/buy `<token>` `<amount_sol>` - Buy tokens\n"
+    "/sell `<token>` `<amount>` - Sell tokens\n"
+    "/portfolio - View portfolio\n"
+    "/leaderboard - Top traders\n"
+    "/history - Trade history\n\n"
+    "*Token Info:*\n"
+    "/info `<token>` - Full token details\n"
+    "/price `<token>` - Quick price check\n"
+    "/chart `<token>` - Price chart link\n\n"
+    "*Tools:*\n"
+    "/watch `<token>` - Add to watchlist\n"
+    "/watchlist - View watchlist\n"
+    "/alert `<token>` `<price>` - Set price alert\n"
+    "/alerts - View all alerts\n"
+    "/settings - Configure bot\n\n"
+    "*Account:*\n"
+    "/fund `<amount>` - Add virtual SOL\n"
+    "/reset - Reset portfolio\n"
+    "/stats - Your trading stats\n\n"
+    "💡 *Tip:* Just paste a token address for instant info!"
+)
+
+# Trade receipts for /buy, /sell and the quick buy buttons
+BUY_TEMPLATE = (
+    "✅ *Bought {tokens:.2f} {symbol}*\n\n"
+    "💵 Price: {price:.9f} SOL (Slip: {slippage:.2f}%)\n"
+    "{source}"
+    "💰 Spent: {spent:.4f} SOL\n"
+    "💰 New Balance: {balance:.4f} SOL"
+)
+SELL_TEMPLATE = (
+    "✅ *Sold {amount:.2f} {symbol}*\n\n"
+    "💵 Price: {price:.9f} SOL (Slip: {slippage:.2f}%)\n"
+    "💰 Received: {received:.4f} SOL\n"
+    "{profit_emoji} *P/L:* {profit:.4f} SOL ({profit_pct:+.2f}%)\n"
+    "💰 New Balance: {balance:.4f} SOL"
+)
+
+# Position detail screen and the receipts for its Buy/Sell buttons
+POSITION_TEMPLATE = (
+    "🪙 *{symbol} Position*\n\n"
+    "📊 *Holdings:* {amount:.2f}\n"
+    "💰 *Value:* {value:.4f} SOL (~${value_usd:.2f})\n\n"
+    "📍 *Entry Price:* {avg_price:.9f} SOL\n"
+    "💵 *Current Price:* {price:.9f} SOL\n"
+    "{source}"
+    "\n{profit_emoji} *Unrealized P/L:*\n"
+    "   {profit:.4f} SOL ({profit_pct:+.2f}%)\n"
+    "{change}"
+)
+POSITION_BUY_TEMPLATE = (
+    "✅ *Bought {tokens:.2f} more!*\n\n"
+    "💵 Price: {price:.9f} SOL (Slip: {slippage:.2f}%)\n"
+    "💰 Spent: {spent:.4f} SOL\n"
+    " New Position: {position:.2f}\n"
+    "📍 New Avg: {avg_price:.9f} SOL\n"
+    "💰 Balance: {balance:.4f} SOL\n\n"
+    "Use /portfolio to see updated positions"
+)
+POSITION_SELL_TEMPLATE = (
+    "✅ *Sold {percentage:.0f}% ({amount:.2f} tokens)*\n\n"
+    "💵 Price: {price:.9f} SOL (Slip: {slippage:.2f}%)\n"
+    "💰 Received: {received:.4f} SOL\n"
+    "{profit_emoji} *P/L:* {profit:.4f} SOL ({profit_pct:+.2f}%)\n"
+    "💰 New Balance: {balance:.4f} SOL\n\n"
+    "Use /portfolio to see updated positions"
+)
+
+# /admin analytics; {commands} is one "\n• /cmd: count" line per top command
+ADMIN_TEMPLATE = (
+    "📊 *Bot Analytics (Admin)*\n\n"
+    "👥 Total Users: {total_users}\n"
+    "🆕 New Today: {new_today}\n\n"
+    "🔥 *Activity:*\n"
+    "• DAU (24h): {dau}\n"
+    "• Weekly (7d): {active_7d}\n"
+    "• MAU (30d): {mau}\n\n"
+    "⌨️ *Top Commands:*{commands}"
+)
+
+def pair_liquidity(pair):
+    """Sort key for DexScreener pairs: USD liquidity, 0 when missing"""
+    liquidity = pair.get('liquidity')
+    return (liquidity and liquidity.get('usd')) or 0
+
+def dump_default(obj):
+    """orjson fallback for the admin dump: trade histories as lists, anything else as text"""
+    if isinstance(obj, deque):
+        return list(obj)
+    return str(obj)
+
+def try_float(text):
+    """Parse a user-supplied number, None if it isn't one"""
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def env_number(name, default, cast=float):
+    """Numeric setting from the environment (after load_dotenv), default when unset or invalid"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        log.error("❌ %s=%r is not a number, using %s", name, value, default)
+        return default
+
+def compute_equity(balances, idx, amounts, prices, starting_balance):
+    """Leaderboard kernel: per-trader equity and P/L %, adding each position's value
+    to the balance at its trader index (np.bincount does the scatter-add in C)"""
+    equity = balances + np.bincount(idx, weights=amounts * prices, minlength=len(balances))
+    return equity, (equity / starting_balance - 1) * 100
+
+@lru_cache(maxsize=1024)
+def info_keyboard(token):
+    """Quick action buttons for a token (markups are immutable, so they can be shared)"""
+    keyboard = [
+        [
+            InlineKeyboardButton("🔄 Refresh Price", callback_data=f"refresh_{token}"),
+        ],
+        [
+            InlineKeyboardButton("📈 Buy 0.5 SOL", callback_data=f"qbuy_{token}_0.5"),
+            InlineKeyboardButton("📈 Buy 1.0 SOL", callback_data=f"qbuy_{token}_1.0")
+        ],
+        [
+            InlineKeyboardButton("⭐ Add to Watchlist", callback_data=f"watch_{token}")
+        ]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
 class PaperTradingBot:
     def __init__(self):
         self.starting_balance = 20.0  # 10 SOL starting balance
-        self.price_cache = {}  # Cache for API responses
+        self.rng = np.random.default_rng()  # For bulk slippage simulation
+        self.price_cache = TTLCache(maxsize=10_000, ttl=env_number("PRICE_CACHE_TTL", DEFAULT_PRICE_CACHE_TTL))  # Cache for API responses (bounded)
+        self.token_lookups = {}  # token -> in-flight lookup task
+        self.render_cache = TTLCache(maxsize=10_000, ttl=RENDER_CACHE_TTL)  # user_id -> (msg, reply_markup)
+        self.portfolio_versions = {}  # user_id -> count of portfolio changes, see _render_portfolio
+        self.http_session = None  # Shared aiohttp session, created on first request
+        self.sol_price = 0  # Last SOL/USD price, shared by all lookups
+        self.sol_price_expiry = 0
+        self.sol_price_task = None  # In-flight SOL price request, if any
+        self.now_iso = ''  # Last trade timestamp handed out, see _now_iso
+        self.now_iso_at = 0.0
         self.data_lock = asyncio.Lock()  # Prevent data corruption
+        self.dirty = asyncio.Event()  # Set when there are unsaved changes
+        self.dirty_rows = {}  # user_id -> tables with unsaved changes
+        self.pending_trades = {}  # user_id -> trades not yet written
+        self.pending_resets = set()  # Users whose stored history must be cleared
+        self.flush_task = None
+        self.save_delay = SAVE_DELAY  # Doubles after each failed save, up to SAVE_RETRY_MAX
+        self.closing = asyncio.Event()  # Set by post_shutdown to stop the flush loop
+        # Admin analytics, kept up to date by log_activity so /admin_stats doesn't scan every user
+        self.recent_users = OrderedDict()  # user_id -> last_active, least recently active first
+        self.join_times = []  # joined_at of every user, sorted
+        self.command_totals = Counter()  # command -> uses across all users
+        # Position screen buttons: callback prefix -> handler(query, user_id, token, arg)
+        self.position_callbacks = {
+            'back': self._position_back,
+            'posrefresh': self._position_refresh,
+            'poschart': self._position_chart,
+            'posbuy': self._position_buy,
+            'possell': self._position_sell
+        }
+        # Only this Telegram user can run the admin commands; None disables them
+        admin_id = os.getenv("ADMIN_USER_ID", "")
+        self.admin_id = int(admin_id) if admin_id.isdigit() else None
+        self.history_limit = max(env_number("HISTORY_LIMIT", DEFAULT_HISTORY_LIMIT, int), 1)
+        self.db = self.open_db(os.getenv("DATABASE_URL", DEFAULT_DATABASE_URL))
         self.load_data()
+        # Last-chance save if the process exits without running post_shutdown,
+        # which unregisters it
+        atexit.register(self._flush_at_exit)
 
     def apply_slippage(self, price, is_buy, user_id):
         """Calculate execution price based on user's slippage settings"""
@@ -41,58 +284,370 @@ class PaperTradingBot:
         exec_price = price * (1 + impact) if is_buy else price * (1 - impact)
         return exec_price, impact * 100
 
+    def apply_slippage_batch(self, prices, is_buy, slippage_pcts):
+        """Vectorized apply_slippage for many fills at once (backtests, bulk simulation).
+        
+        Takes arrays of prices, buy flags and slippage tolerances in percent and
+        returns (exec_prices, slippage_hit_pcts) as arrays.
+        """
+        prices = np.asarray(prices, dtype=np.float64)
+        impacts = self.rng.uniform(0, np.asarray(slippage_pcts, dtype=np.float64) / 100, size=prices.shape)
+        exec_prices = prices * np.where(is_buy, 1 + impacts, 1 - impacts)
+        return exec_prices, impacts * 100
+
+    def _now_iso(self):
+        """ISO timestamp for trade records, reused for calls within the same millisecond"""
+        now = time.monotonic()
+        if now - self.now_iso_at >= 0.001:
+            self.now_iso = datetime.now().isoformat()
+            self.now_iso_at = now
+        return self.now_iso
+
+    def open_db(self, database_url):
+        """Open the SQLite database and make sure the schema exists"""
+        if not database_url.startswith('sqlite:///'):
+            # Hosts often inject a Postgres DATABASE_URL; don't log it, it carries credentials
+            log.error("❌ DATABASE_URL is not a sqlite:/// URL, using %s instead", DEFAULT_DATABASE_URL)
+            database_url = DEFAULT_DATABASE_URL
+        path = database_url.removeprefix('sqlite:///')
+        # Autocommit mode; multi-statement writes use explicit transactions.
+        # Writes run in executor threads, serialized by data_lock.
+        db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(SCHEMA)
+        self._migrate_history_column(db)
+        return db
+
+    def _migrate_history_column(self, db):
+        """Move history stored inline in portfolios rows into the trades table"""
+        columns = [row[1] for row in db.execute("PRAGMA table_info(portfolios)")]
+        if 'history' not in columns:
+            return
+        db.execute("BEGIN")
+        for user_id, history in db.execute("SELECT user_id, history FROM portfolios").fetchall():
+            db.executemany(
+                "INSERT INTO trades (user_id, trade) VALUES (?, ?)",
+                [(user_id, orjson.dumps(trade).decode()) for trade in orjson.loads(history)]
+            )
+        db.execute("ALTER TABLE portfolios DROP COLUMN history")
+        db.execute("COMMIT")
+        log.info("✅ Moved trade history into the trades table")
+
     def load_data(self):
-        """Load bot data from file"""
-        global portfolios, watchlists, user_settings, user_stats
-        filename = 'paper_trading_data.json'
-        if os.path.exists(filename):
-            try:
-                with open(filename, 'r') as f:
-                    data = json.load(f)
-                    # Convert string keys back to integers for user_ids
-                    if 'portfolios' in data:
-                        portfolios.clear()
-                        for k, v in data['portfolios'].items():
-                            portfolios[int(k)] = v
-                    if 'watchlists' in data:
-                        watchlists.clear()
-                        for k, v in data['watchlists'].items():
-                            watchlists[int(k)] = v
-                    if 'user_settings' in data:
-                        user_settings.clear()
-                        for k, v in data['user_settings'].items():
-                            user_settings[int(k)] = v
-                    if 'user_stats' in data:
-                        user_stats.clear()
-                        for k, v in data['user_stats'].items():
-                            user_stats[int(k)] = v
-                print("✅ Data loaded successfully")
-            except Exception as e:
-                print(f"❌ Error loading data: {e}")
+        """Load bot data from the database"""
+        if not self.db.execute("SELECT 1 FROM portfolios LIMIT 1").fetchone():
+            self._import_legacy_data()
+        try:
+            portfolios.clear()
+            for user_id, balance, positions in self.db.execute(
+                    "SELECT user_id, balance, positions FROM portfolios"):
+                portfolios[user_id] = {
+                    'balance': balance,
+                    'positions': orjson.loads(positions),
+                    'history': deque(maxlen=self.history_limit)
+                }
+                self._trade_totals(portfolios[user_id])
+            # Only the latest trades stay in memory, but the /stats totals cover all of them
+            for user_id, trade in self.db.execute("SELECT user_id, trade FROM trades ORDER BY id"):
+                if user_id in portfolios:
+                    trade = orjson.loads(trade)
+                    portfolios[user_id]['history'].append(trade)
+                    self._count_trade(portfolios[user_id], trade)
+            watchlists.clear()
+            for user_id, token in self.db.execute("SELECT user_id, token FROM watchlists ORDER BY rowid"):
+                watchlists.setdefault(user_id, []).append(token)
+            user_settings.clear()
+            for user_id, settings in self.db.execute("SELECT user_id, settings FROM user_settings"):
+                user_settings[user_id] = orjson.loads(settings)
+            user_stats.clear()
+            for user_id, stats in self.db.execute("SELECT user_id, stats FROM user_stats"):
+                stats = self._parse_stats(user_id, stats)
+                if stats is not None:
+                    user_stats[user_id] = stats
+            self._index_activity()
+            log.info("✅ Data loaded successfully")
+        except Exception as e:
+            log.error("❌ Error loading data: %s", e)
+
+    def _parse_stats(self, user_id, raw):
+        """Decode a user_stats row with epoch millisecond timestamps, or None if it's unusable"""
+        try:
+            stats = orjson.loads(raw)
+            converted = False
+            for key in ('joined_at', 'last_active'):
+                value = stats[key]
+                # Older rows stored ISO strings. Converted rows are written back
+                # so they're parsed only once, not on every start.
+                if isinstance(value, str):
+                    stats[key] = int(datetime.fromisoformat(value).timestamp() * 1000)
+                    converted = True
+                elif not isinstance(value, (int, float)):
+                    raise TypeError(f"{key} is {type(value).__name__}")
+            # Share the command-name keys with the literals log_activity uses
+            stats['commands'] = Counter({sys.intern(cmd): n for cmd, n in stats.get('commands', {}).items()})
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            log.warning("⚠️ Dropping unreadable stats for user %s: %s", user_id, e)
+            return None
+        if converted:
+            self.mark_dirty(user_id, 'user_stats')
+        return stats
+
+    def _index_activity(self):
+        """Rebuild the admin analytics indexes from user_stats"""
+        tracked = sorted(user_stats.items(), key=lambda u: u[1]['last_active'])
+        self.recent_users = OrderedDict((user_id, stats['last_active']) for user_id, stats in tracked)
+        self.join_times = sorted(stats['joined_at'] for _, stats in tracked)
+        self.command_totals = Counter()
+        for _, stats in tracked:
+            self.command_totals.update(stats['commands'])
+
+    def _import_legacy_data(self):
+        """One-shot import of the old MessagePack/JSON data file into the database"""
+        filename = next((f for f in LEGACY_DATA_FILES if os.path.exists(f)), None)
+        if not filename:
+            return
+        try:
+            with open(filename, 'rb') as f:
+                raw = f.read()
+            if filename.endswith('.msgpack'):
+                # MessagePack keeps the integer user_id keys as they are
+                data = msgpack.unpackb(raw, raw=False, strict_map_key=False)
+            else:
+                data = orjson.loads(raw)
+                # JSON only has string keys, convert them back to integer user_ids
+                for section, section_data in data.items():
+                    if isinstance(section_data, dict):
+                        data[section] = {int(k): v for k, v in section_data.items()}
+            stores = {
+                'portfolios': portfolios,
+                'watchlists': watchlists,
+                'user_settings': user_settings,
+                'user_stats': user_stats
+            }
+            user_ids = set()
+            for section, store in stores.items():
+                section_data = data.get(section, {})
+                store.update(section_data)
+                user_ids.update(section_data)
+            self.db.execute("BEGIN")
+            for user_id in user_ids:
+                history = portfolios.get(user_id, {}).get('history', [])
+                self._write_user_rows(self._encode_user(user_id, stores, new_trades=history))
+            self.db.execute("COMMIT")
+            log.info("✅ Imported %d users from %s", len(user_ids), filename)
+        except Exception as e:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            log.error("❌ Error importing %s: %s", filename, e)
+
+    def _encode_user(self, user_id, tables, new_trades=(), reset_history=False):
+        """Serialize a user's rows in the given tables (on the event loop, so the data can't change mid-write)"""
+        rows = {
+            'user_id': user_id,
+            # History is append-only: only new trades are written, never the whole list
+            'new_trades': [orjson.dumps(trade, default=str, option=ORJSON_OPTIONS).decode() for trade in new_trades],
+            'reset_history': reset_history
+        }
+        if 'portfolios' in tables and user_id in portfolios:
+            portfolio = portfolios[user_id]
+            rows['portfolios'] = (portfolio['balance'], orjson.dumps(portfolio['positions'], option=ORJSON_OPTIONS).decode())
+        if 'watchlists' in tables:
+            rows['watchlists'] = list(watchlists.get(user_id, []))
+        if 'user_settings' in tables and user_id in user_settings:
+            rows['user_settings'] = orjson.dumps(user_settings[user_id]).decode()
+        if 'user_stats' in tables and user_id in user_stats:
+            rows['user_stats'] = orjson.dumps(user_stats[user_id], default=str, option=ORJSON_OPTIONS).decode()
+        return rows
+
+    def _write_user_rows(self, rows):
+        """Write one user's encoded rows; caller owns the transaction"""
+        user_id = rows['user_id']
+        if 'portfolios' in rows:
+            self.db.execute(
+                "INSERT INTO portfolios (user_id, balance, positions) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET balance=excluded.balance, positions=excluded.positions",
+                (user_id, *rows['portfolios'])
+            )
+        if rows['reset_history']:
+            self.db.execute("DELETE FROM trades WHERE user_id = ?", (user_id,))
+        self.db.executemany(
+            "INSERT INTO trades (user_id, trade) VALUES (?, ?)",
+            [(user_id, trade) for trade in rows['new_trades']]
+        )
+        if 'watchlists' in rows:
+            self.db.execute("DELETE FROM watchlists WHERE user_id = ?", (user_id,))
+            self.db.executemany(
+                "INSERT INTO watchlists (user_id, token) VALUES (?, ?)",
+                [(user_id, token) for token in rows['watchlists']]
+            )
+        if 'user_settings' in rows:
+            self.db.execute(
+                "INSERT OR REPLACE INTO user_settings (user_id, settings) VALUES (?, ?)",
+                (user_id, rows['user_settings'])
+            )
+        if 'user_stats' in rows:
+            self.db.execute(
+                "INSERT OR REPLACE INTO user_stats (user_id, stats) VALUES (?, ?)",
+                (user_id, rows['user_stats'])
+            )
+
+    def _save_rows_sync(self, all_rows):
+        """Helper to write users' rows in one transaction (runs in background thread).
+        Each user is written under a savepoint, so a failing row only rolls back that
+        user; returns {user_id: error} for them."""
+        failed = {}
+        self.db.execute("BEGIN")
+        try:
+            for rows in all_rows:
+                self.db.execute("SAVEPOINT user_rows")
+                try:
+                    self._write_user_rows(rows)
+                except Exception as e:
+                    self.db.execute("ROLLBACK TO user_rows")
+                    failed[rows['user_id']] = e
+                self.db.execute("RELEASE user_rows")
+            self.db.execute("COMMIT")
+        except Exception:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            raise
+        return failed
+
+    def mark_dirty(self, user_id, table, reset_history=False):
+        """Queue one of a user's rows (portfolios, watchlists, user_settings or user_stats)
+        to be saved by the background flusher; untouched rows are not rewritten"""
+        if reset_history:
+            self.pending_trades.pop(user_id, None)
+            self.pending_resets.add(user_id)
+        if table == 'portfolios':
+            # Any balance or position change makes the rendered portfolio stale,
+            # including one that is being rendered right now
+            self.render_cache.pop(user_id, None)
+            self.portfolio_versions[user_id] = self.portfolio_versions.get(user_id, 0) + 1
+        self.dirty_rows.setdefault(user_id, set()).add(table)
+        self.dirty.set()
+
+    def record_trade(self, user_id, trade):
+        """Add a trade to the user's history and queue it to be saved"""
+        portfolio = portfolios[user_id]
+        # Count before appending: once the history is full the totals can't be rebuilt from it
+        self._count_trade(self._trade_totals(portfolio), trade)
+        portfolio['history'].append(trade)
+        self.pending_trades.setdefault(user_id, []).append(trade)
+        self.mark_dirty(user_id, 'portfolios')
+
+    def _count_trade(self, portfolio, trade):
+        """Add a trade to the portfolio's running /stats totals"""
+        if trade['type'] == 'BUY':
+            portfolio['n_buys'] += 1
+        else:
+            profit = trade.get('profit', 0)
+            portfolio['n_sells'] += 1
+            portfolio['n_wins'] += profit > 0
+            portfolio['n_losses'] += profit < 0
+            portfolio['realized_pnl'] += profit
+
+    def _trade_totals(self, portfolio):
+        """Running /stats totals, built from the history the first time they are needed"""
+        if 'n_buys' not in portfolio:
+            portfolio.update(n_buys=0, n_sells=0, n_wins=0, n_losses=0, realized_pnl=0.0)
+            for trade in portfolio['history']:
+                self._count_trade(portfolio, trade)
+        return portfolio
 
-    async def save_data(self):
-        """Save bot data to file asynchronously to prevent blocking"""
+    async def flush(self):
+        """Write every row changed since the last flush"""
         async with self.data_lock:
-            filename = 'paper_trading_data.json'
+            if not self.dirty_rows:
+                return
+            dirty_rows, self.dirty_rows = self.dirty_rows, {}
+            new_trades, self.pending_trades = self.pending_trades, {}
+            resets, self.pending_resets = self.pending_resets, set()
+            all_rows = []
+            failed = {}
+            for user_id, tables in dirty_rows.items():
+                try:
+                    all_rows.append(self._encode_user(user_id, tables, new_trades.get(user_id, ()), user_id in resets))
+                except Exception as e:
+                    failed[user_id] = e
             try:
-                data = {
-                    'portfolios': portfolios,
-                    'watchlists': watchlists,
-                    'user_settings': user_settings,
-                    'user_stats': user_stats
-                }
                 # Run blocking I/O in a separate thread
                 loop = asyncio.get_running_loop()
-                await loop.run_in_executor(None, self._write_file_sync, filename, data)
+                failed.update(await loop.run_in_executor(None, self._save_rows_sync, all_rows))
             except Exception as e:
-                print(f"❌ Error saving data: {e}")
-    
-    def _write_file_sync(self, filename, data):
-        """Helper to write file synchronously (runs in background thread)"""
-        temp_file = f"{filename}.tmp"
-        with open(temp_file, 'w') as f:
-            json.dump(data, f, indent=2, default=str)
-        os.replace(temp_file, filename)
+                log.error("❌ Error saving data: %s", e)
+                failed = dirty_rows
+            else:
+                for user_id, e in failed.items():
+                    log.error("❌ Error saving data for user %s: %s", user_id, e)
+            
+            if not failed:
+                self.save_delay = SAVE_DELAY
+                return
+            # Keep the failed users' changes queued for the next attempt
+            for user_id in failed:
+                self.dirty_rows.setdefault(user_id, set()).update(dirty_rows[user_id])
+                if user_id in new_trades:
+                    self.pending_trades[user_id] = new_trades[user_id] + self.pending_trades.get(user_id, [])
+                if user_id in resets:
+                    self.pending_resets.add(user_id)
+            # Retry without waiting for a new change, backing off while the fault lasts
+            self.save_delay = min(self.save_delay * 2, SAVE_RETRY_MAX)
+            self.dirty.set()
+
+    def _flush_at_exit(self):
+        """Synchronously write anything still queued when the interpreter exits"""
+        if not self.dirty_rows:
+            return
+        try:
+            failed = self._save_rows_sync([
+                self._encode_user(user_id, tables, self.pending_trades.get(user_id, ()), user_id in self.pending_resets)
+                for user_id, tables in self.dirty_rows.items()
+            ])
+            for user_id, e in failed.items():
+                log.error("❌ Error saving data for user %s at exit: %s", user_id, e)
+            self.dirty_rows.clear()
+            self.pending_trades.clear()
+            self.pending_resets.clear()
+        except Exception as e:
+            log.error("❌ Error saving data at exit: %s", e)
+
+    async def _flush_loop(self):
+        """Save changes in the background, coalescing bursts into one write"""
+        while not self.closing.is_set():
+            await self.dirty.wait()
+            if self.closing.is_set():
+                break
+            # Shutdown cuts the wait short rather than sitting out a retry backoff
+            try:
+                await asyncio.wait_for(self.closing.wait(), self.save_delay)
+            except asyncio.TimeoutError:
+                pass
+            self.dirty.clear()
+            await self.flush()
+
+    async def post_init(self, application: Application):
+        """Start background tasks once the event loop is running"""
+        self.flush_task = asyncio.create_task(self._flush_loop())
+        # Open the HTTP session up front rather than on the first user's lookup
+        await self._ensure_session()
+
+    async def post_shutdown(self, application: Application):
+        """Write pending changes, then close the HTTP session and the database"""
+        if self.flush_task:
+            # Stop the loop instead of cancelling it, so a write already running
+            # in the executor finishes (or re-queues its rows) before the final flush
+            self.closing.set()
+            self.dirty.set()
+            await self.flush_task
+        await self.flush()
+        if self.http_session:
+            await self.http_session.close()
+        async with self.data_lock:
+            self.db.close()
+        # Shutdown already saved what it could; the exit hook would only hit a closed database
+        atexit.unregister(self._flush_at_exit)
         
     async def log_activity(self, update: Update, command_name: str):
         """Track user activity for analytics"""
@@ -101,7 +656,7 @@ class PaperTradingBot:
             return
             
         user_id = user.id
-        now = datetime.now().isoformat()
+        now = int(time.time() * 1000)
         
         if user_id not in user_stats:
             user_stats[user_id] = {
@@ -109,16 +664,19 @@ class PaperTradingBot:
                 'first_name': user.first_name,
                 'joined_at': now,
                 'last_active': now,
-                'commands': {}
+                'commands': Counter()
             }
+            self.join_times.append(now)
         
         stats = user_stats[user_id]
         stats['last_active'] = now
         stats['username'] = user.username
         
-        if command_name not in stats['commands']:
-            stats['commands'][command_name] = 0
         stats['commands'][command_name] += 1
+        self.command_totals[command_name] += 1
+        self.recent_users[user_id] = now
+        self.recent_users.move_to_end(user_id)
+        self.mark_dirty(user_id, 'user_stats')
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await self.log_activity(update, "start")
@@ -127,46 +685,216 @@ class PaperTradingBot:
             portfolios[user_id] = {
                 'balance': self.starting_balance,
                 'positions': {},
-                'history': []
+                'history': deque(maxlen=self.history_limit)
             }
-            await self.save_data()
+            self.mark_dirty(user_id, 'portfolios')
         
         await update.message.reply_text(
-            f"🤖 *Solana Memecoin Paper Trading Bot*\n\n"
-            f"💰 Balance: {portfolios[user_id]['balance']:.4f} SOL\n\n"
-            f"*Trading Commands:*\n"
-            f"/buy `<token>` `<amount_sol>` - Buy tokens\n"
-            f"/sell `<token>` `<amount>` - Sell tokens\n"
-            f"/portfolio - View portfolio\n"
-            f"/leaderboard - Top traders\n"
-            f"/history - Trade history\n\n"
-            f"*Token Info:*\n"
-            f"/info `<token>` - Full token details\n"
-            f"/price `<token>` - Quick price check\n"
-            f"/chart `<token>` - Price chart link\n\n"
-            f"*Tools:*\n"
-            f"/watch `<token>` - Add to watchlist\n"
-            f"/watchlist - View watchlist\n"
-            f"/alert `<token>` `<price>` - Set price alert\n"
-            f"/alerts - View all alerts\n"
-            f"/settings - Configure bot\n\n"
-            f"*Account:*\n"
-            f"/fund `<amount>` - Add virtual SOL\n"
-            f"/reset - Reset portfolio\n"
-            f"/stats - Your trading stats\n\n"
-            f"💡 *Tip:* Just paste a token address for instant info!",
+            START_TEMPLATE.format(balance=portfolios[user_id]['balance']),
             parse_mode='Markdown'
         )
     
+    async def _ensure_session(self):
+        """Return the shared HTTP session so connections are kept alive between requests"""
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=100,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+                ssl=False  # Disable SSL verification as fallback
+            )
+            self.http_session = aiohttp.ClientSession(
+                connector=connector,
+                # Sources are raced, so a stalled one shouldn't hold up a lookup for long
+                timeout=aiohttp.ClientTimeout(total=5)
+            )
+        return self.http_session
+
+    async def _fetch_sol_price(self, session):
+        """Fetch the global SOL price in USD (needed for conversions), 0 if unavailable"""
+        sol_price = 0
+        try:
+            async with session.get(SOL_JUP_URL) as sol_resp:
+                if sol_resp.status == 200:
+                    sol_json = orjson.loads(await sol_resp.read())
+                    sol_price = float(sol_json['data']['SOL']['price'])
+        except Exception as e:
+            log.warning("⚠️ Failed to fetch SOL price from Jupiter: %s", e)
+            # Fallback: Try DexScreener for SOL price (Wrapped SOL)
+            try:
+                async with session.get(SOL_DEX_URL) as sol_dex_resp:
+                    if sol_dex_resp.status == 200:
+                        sol_data = orjson.loads(await sol_dex_resp.read())
+                        if sol_data.get('pairs'):
+                            # Use the first pair's priceUsd
+                            sol_price = float(sol_data['pairs'][0].get('priceUsd', 0))
+                            log.info("✅ Fetched SOL price from DexScreener: $%s", sol_price)
+            except Exception as e2:
+                log.warning("⚠️ Failed to fetch SOL price from DexScreener: %s", e2)
+        return sol_price
+
+    async def _get_sol_price(self, session):
+        """SOL price shared by every lookup: fetched at most once per SOL_PRICE_TTL,
+        and concurrent callers wait on the same request instead of each sending one"""
+        now = time.monotonic()  # Immune to wall-clock jumps (NTP, VM clock skew)
+        if now < self.sol_price_expiry:
+            return self.sol_price
+        if self.sol_price_task is None or self.sol_price_task.done():
+            self.sol_price_task = asyncio.create_task(self._fetch_sol_price(session))
+        # Shielded so one caller being cancelled doesn't cancel the request for everyone
+        sol_price = await asyncio.shield(self.sol_price_task)
+        if sol_price:  # Don't cache a failed fetch
+            self.sol_price = sol_price
+            self.sol_price_expiry = now + SOL_PRICE_TTL
+        return sol_price
+
+    async def _fetch_pump(self, session, token_address, sol_price_task):
+        """Price a token still on its Pump.fun bonding curve"""
+        try:
+            pump_url = f"https://frontend-api.pump.fun/coins/{token_address}"
+            async with session.get(pump_url, headers=PUMP_HEADERS) as response:
+                if response.status == 200:
+                    data = orjson.loads(await response.read())
+                    # Only use Pump.fun if the curve is NOT complete (still on bonding curve)
+                    # If complete, DexScreener (Raydium) is usually more accurate
+                    if 'mint' in data and not data.get('complete', False):
+                        v_sol = int(data.get('virtual_sol_reserves', 0))
+                        v_token = int(data.get('virtual_token_reserves', 0))
+
+                        if v_token > 0:
+                            sol_price = await sol_price_task
+                            # Calculate price: (Virtual SOL / 1e9) / (Virtual Token / 1e6)
+                            price_sol = (v_sol / 1e9) / (v_token / 1e6)
+                            found = {
+                                'price': price_sol, # Price in SOL
+                                'price_usd': price_sol * sol_price if sol_price else 0,
+                                'name': data.get('name', 'Unknown'),
+                                'symbol': data.get('symbol', 'Unknown'),
+                                'market_cap': data.get('market_cap', 0) * sol_price, # MC usually in USD
+                                'dex_name': 'Pump.fun (Bonding Curve)',
+                                'price_timestamp': datetime.now()
+                            }
+                            if data.get('created_timestamp'):
+                                found['created_at'] = datetime.fromtimestamp(data.get('created_timestamp') / 1000)
+                            return found
+        except Exception as e:
+            log.warning("⚠️ Pump.fun failed: %s", e)
+        return None
+
+    async def _fetch_dexscreener(self, session, token_address, sol_price_task):
+        """Primary source: DexScreener (most reliable)"""
+        try:
+            dex_url = f"https://api.dexscreener.com/latest/dex/tokens/{token_address}"
+            async with session.get(dex_url) as response:
+                if response.status == 200:
+                    data = orjson.loads(await response.read())
+                    if 'pairs' in data and len(data['pairs']) > 0:
+                        # Get the pair with highest liquidity (most accurate price)
+                        pair = max(data['pairs'], key=pair_liquidity)
+                        
+                        found = {
+                            'name': pair.get('baseToken', {}).get('name', 'Unknown'),
+                            'symbol': pair.get('baseToken', {}).get('symbol', 'Unknown'),
+                            'price_usd': float(pair.get('priceUsd', 0)),
+                            'market_cap': pair.get('fdv'),
+                            'liquidity': pair.get('liquidity', {}).get('usd'),
+                            'volume_24h': pair.get('volume', {}).get('h24'),
+                            'price_change_24h': pair.get('priceChange', {}).get('h24'),
+                            'dex_name': pair.get('dexId', 'Unknown DEX'),
+                            'pair_address': pair.get('pairAddress', ''),
+                            'price_timestamp': datetime.now()
+                        }
+                        sol_price = await sol_price_task
+                        if sol_price > 0:
+                            found['price'] = found['price_usd'] / sol_price
+                        
+                        # Created timestamp
+                        created = pair.get('pairCreatedAt')
+                        if created:
+                            found['created_at'] = datetime.fromtimestamp(created / 1000)
+                        
+                        if found.get('price') is not None:
+                            log.debug("✅ DexScreener: Found %s at %.9f SOL", found['symbol'], found['price'])
+                        else:
+                            log.warning("⚠️ DexScreener: Found %s ($ %s) but SOL price is missing", found['symbol'], found['price_usd'])
+                        return found
+        except Exception as e:
+            log.warning("⚠️ DexScreener failed: %s", e)
+        return None
+
+    async def _fetch_jupiter(self, session, token_address, sol_price_task):
+        """Fallback 1: Jupiter aggregated price"""
+        try:
+            price_url = f"https://price.jup.ag/v4/price?ids={token_address}"
+            async with session.get(price_url) as response:
+                if response.status == 200:
+                    data = orjson.loads(await response.read())
+                    if 'data' in data and token_address in data['data']:
+                        price_data = data['data'][token_address]
+                        found = {
+                            'price_usd': float(price_data.get('price', 0)),
+                            'dex_name': 'Jupiter Aggregated',
+                            'price_timestamp': datetime.now()
+                        }
+                        sol_price = await sol_price_task
+                        if sol_price > 0:
+                            found['price'] = found['price_usd'] / sol_price
+                            log.debug("✅ Jupiter: Found price %.9f SOL", found['price'])
+                        else:
+                            log.warning("⚠️ Jupiter: Found price $%s but SOL price is missing", found['price_usd'])
+                        return found
+        except Exception as e:
+            log.warning("⚠️ Jupiter failed: %s", e)
+        return None
+
+    async def _fetch_birdeye(self, session, token_address, sol_price_task):
+        """Fallback 2: Birdeye public price"""
+        try:
+            birdeye_url = f"https://public-api.birdeye.so/public/price?address={token_address}"
+            async with session.get(birdeye_url, headers=BIRDEYE_HEADERS) as response:
+                if response.status == 200:
+                    data = orjson.loads(await response.read())
+                    if 'data' in data and 'value' in data['data']:
+                        found = {
+                            'price_usd': float(data['data']['value']),
+                            'dex_name': 'Birdeye',
+                            'price_timestamp': datetime.now()
+                        }
+                        sol_price = await sol_price_task
+                        if sol_price > 0:
+                            found['price'] = found['price_usd'] / sol_price
+                            log.debug("✅ Birdeye: Found price %.9f SOL", found['price'])
+                        else:
+                            log.warning("⚠️ Birdeye: Found price $%s but SOL price is missing", found['price_usd'])
+                        return found
+        except Exception as e:
+            log.warning("⚠️ Birdeye failed: %s", e)
+        return None
+
     async def get_token_info(self, token_address):
         """Get comprehensive token information with multiple API fallbacks"""
         # 1. Check Cache (Optimization)
-        current_time = time.time()
-        if token_address in self.price_cache:
-            cached = self.price_cache[token_address]
-            if current_time - cached['timestamp'] < 10:  # 10 seconds cache
-                return cached['data']
+        cached = self.price_cache.get(token_address)
+        if cached is not None:
+            return cached
+
+        # Concurrent callers for the same token wait on one in-flight lookup
+        task = self.token_lookups.get(token_address)
+        if task is None:
+            task = asyncio.create_task(self._lookup_token_info(token_address))
+            self.token_lookups[token_address] = task
+            task.add_done_callback(lambda done: self._finish_lookup(token_address, done))
+        # Shielded so one caller being cancelled doesn't cancel the lookup for everyone
+        return await asyncio.shield(task)
 
+    def _finish_lookup(self, token_address, task):
+        """Cache a completed lookup and drop it from the in-flight map"""
+        del self.token_lookups[token_address]
+        if not task.cancelled() and task.exception() is None:
+            self.price_cache[token_address] = task.result()
+
+    async def _lookup_token_info(self, token_address):
+        """Query every price source for a token, uncached"""
         info = {
             'price': None,
             'price_usd': None,
@@ -184,219 +912,97 @@ class PaperTradingBot:
             'price_timestamp': None
         }
         
-        # Create session with timeout
-        timeout = aiohttp.ClientTimeout(total=10)
-        connector = aiohttp.TCPConnector(ssl=False)  # Disable SSL verification as fallback
-        
+        tasks = []
         try:
-            async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
-                # 0. Fetch global SOL price first (needed for conversions)
-                sol_price = 0
-                try:
-                    async with session.get("https://price.jup.ag/v4/price?ids=SOL") as sol_resp:
-                        if sol_resp.status == 200:
-                            sol_json = await sol_resp.json()
-                            sol_price = float(sol_json['data']['SOL']['price'])
-                            info['sol_price'] = sol_price
-                except Exception as e:
-                    print(f"⚠️ Failed to fetch SOL price from Jupiter: {e}")
-                    # Fallback: Try DexScreener for SOL price (Wrapped SOL)
-                    try:
-                        async with session.get("https://api.dexscreener.com/latest/dex/tokens/So11111111111111111111111111111111111111112") as sol_dex_resp:
-                            if sol_dex_resp.status == 200:
-                                sol_data = await sol_dex_resp.json()
-                                if sol_data.get('pairs'):
-                                    # Use the first pair's priceUsd
-                                    sol_price = float(sol_data['pairs'][0].get('priceUsd', 0))
-                                    info['sol_price'] = sol_price
-                                    print(f"✅ Fetched SOL price from DexScreener: ${sol_price}")
-                    except Exception as e2:
-                        print(f"⚠️ Failed to fetch SOL price from DexScreener: {e2}")
-
-                # 1. Try Pump.fun first (User Request for Bonding Curve tokens)
-                try:
-                    pump_url = f"https://frontend-api.pump.fun/coins/{token_address}"
-                    headers = {"User-Agent": "Mozilla/5.0"} # User-Agent is often required
-                    async with session.get(pump_url, headers=headers) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            # Only use Pump.fun if the curve is NOT complete (still on bonding curve)
-                            # If complete, DexScreener (Raydium) is usually more accurate
-                            if 'mint' in data and not data.get('complete', False):
-                                    v_sol = int(data.get('virtual_sol_reserves', 0))
-                                    v_token = int(data.get('virtual_token_reserves', 0))
-
-                                    if v_token > 0:
-                                        # Calculate price: (Virtual SOL / 1e9) / (Virtual Token / 1e6)
-                                        price_sol = (v_sol / 1e9) / (v_token / 1e6)
-                                        info['price'] = price_sol # Price in SOL
-                                        info['price_usd'] = price_sol * sol_price if sol_price else 0
-                                        info['name'] = data.get('name', 'Unknown')
-                                        info['symbol'] = data.get('symbol', 'Unknown')
-                                        info['market_cap'] = data.get('market_cap', 0) * sol_price # MC usually in USD
-                                        info['dex_name'] = 'Pump.fun (Bonding Curve)'
-                                        info['price_timestamp'] = datetime.now()
-                                        if data.get('created_timestamp'):
-                                            info['created_at'] = datetime.fromtimestamp(data.get('created_timestamp') / 1000)
-                                        return info
-                except Exception as e:
-                    print(f"⚠️ Pump.fun failed: {e}")
-
-                # Primary source: DexScreener (most reliable)
-                try:
-                    dex_url = f"https://api.dexscreener.com/latest/dex/tokens/{token_address}"
-                    async with session.get(dex_url) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            if 'pairs' in data and len(data['pairs']) > 0:
-                                # Get the pair with highest liquidity (most accurate price)
-                                pair = max(data['pairs'], key=lambda x: x.get('liquidity', {}).get('usd', 0) or 0)
-                                
-                                info['name'] = pair.get('baseToken', {}).get('name', 'Unknown')
-                                info['symbol'] = pair.get('baseToken', {}).get('symbol', 'Unknown')
-                                info['price_usd'] = float(pair.get('priceUsd', 0))
-                                if sol_price > 0:
-                                    info['price'] = info['price_usd'] / sol_price
-                                info['market_cap'] = pair.get('fdv')
-                                info['liquidity'] = pair.get('liquidity', {}).get('usd')
-                                info['volume_24h'] = pair.get('volume', {}).get('h24')
-                                info['price_change_24h'] = pair.get('priceChange', {}).get('h24')
-                                info['dex_name'] = pair.get('dexId', 'Unknown DEX')
-                                info['pair_address'] = pair.get('pairAddress', '')
-                                info['price_timestamp'] = datetime.now()
-                                
-                                # Created timestamp
-                                created = pair.get('pairCreatedAt')
-                                if created:
-                                    info['created_at'] = datetime.fromtimestamp(created / 1000)
-                                
-                                if info['price'] is not None:
-                                    print(f"✅ DexScreener: Found {info['symbol']} at {info['price']:.9f} SOL")
-                                else:
-                                    print(f"⚠️ DexScreener: Found {info['symbol']} ($ {info['price_usd']}) but SOL price is missing")
-                except Exception as e:
-                    print(f"⚠️ DexScreener failed: {e}")
-                
-                # Fallback 1: Try Jupiter API if DexScreener didn't get price
-                if not info['price']:
-                    try:
-                        price_url = f"https://price.jup.ag/v4/price?ids={token_address}"
-                        async with session.get(price_url) as response:
-                            if response.status == 200:
-                                data = await response.json()
-                                if 'data' in data and token_address in data['data']:
-                                    price_data = data['data'][token_address]
-                                    info['price_usd'] = float(price_data.get('price', 0))
-                                    if sol_price > 0:
-                                        info['price'] = info['price_usd'] / sol_price
-                                    info['dex_name'] = 'Jupiter Aggregated'
-                                    info['price_timestamp'] = datetime.now()
-                                    if info['price'] is not None:
-                                        print(f"✅ Jupiter: Found price {info['price']:.9f} SOL")
-                                    else:
-                                        print(f"⚠️ Jupiter: Found price ${info['price_usd']} but SOL price is missing")
-                    except Exception as e:
-                        print(f"⚠️ Jupiter failed: {e}")
-                
-                # Fallback 2: Try Birdeye API
-                if not info['price']:
-                    try:
-                        birdeye_url = f"https://public-api.birdeye.so/public/price?address={token_address}"
-                        headers = {"X-API-KEY": "public"}  # Public endpoint
-                        async with session.get(birdeye_url, headers=headers) as response:
-                            if response.status == 200:
-                                data = await response.json()
-                                if 'data' in data and 'value' in data['data']:
-                                    info['price_usd'] = float(data['data']['value'])
-                                    if sol_price > 0:
-                                        info['price'] = info['price_usd'] / sol_price
-                                    info['dex_name'] = 'Birdeye'
-                                    info['price_timestamp'] = datetime.now()
-                                    if info['price'] is not None:
-                                        print(f"✅ Birdeye: Found price {info['price']:.9f} SOL")
-                                    else:
-                                        print(f"⚠️ Birdeye: Found price ${info['price_usd']} but SOL price is missing")
-                    except Exception as e:
-                        print(f"⚠️ Birdeye failed: {e}")
-                
+            session = await self._ensure_session()
+            # All sources are queried at once so a miss costs one round-trip, not four.
+            # Results are still applied in priority order: Pump.fun (bonding curve tokens),
+            # DexScreener, then Jupiter and Birdeye as fallbacks.
+            sol_price_task = asyncio.create_task(self._get_sol_price(session))
+            tasks = [
+                asyncio.create_task(fetch(session, token_address, sol_price_task))
+                for fetch in (self._fetch_pump, self._fetch_dexscreener, self._fetch_jupiter, self._fetch_birdeye)
+            ]
+            info['sol_price'] = await sol_price_task
+            for task in tasks:
+                found = await task
+                if found:
+                    info.update(found)
+                    if info['price']:
+                        break
         except Exception as e:
-            print(f"❌ All APIs failed: {e}")
-        
-        # Save to cache
-        self.price_cache[token_address] = {
-            'timestamp': time.time(),
-            'data': info
-        }
+            log.error("❌ All APIs failed: %s", e)
+        finally:
+            # Drop lower-priority requests that are no longer needed
+            for task in tasks:
+                task.cancel()
         return info
     
-    async def info_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Detailed token information"""
-        await self.log_activity(update, "info")
-        if not context.args:
-            await update.message.reply_text("Usage: /info <token_address>")
-            return
-        
-        token = context.args[0]
-        msg = await update.message.reply_text("🔍 Fetching token info...")
-        
-        info = await self.get_token_info(token)
-        
-        if not info['price']:
-            await msg.edit_text("❌ Token not found or invalid address")
-            return
-        
-        # Format the response
-        response = f"🪙 *{info['name'] or 'Unknown'}* ({info['symbol'] or 'N/A'})\n\n"
-        response += f"📍 Address: `{token[:8]}...{token[-8:]}`\n"
+    async def _fetch_infos(self, tokens):
+        """Look up several tokens concurrently, returns {token: info}"""
+        tokens = list(tokens)
+        results = await asyncio.gather(*map(self.get_token_info, tokens))
+        return dict(zip(tokens, results))
+
+    def _format_info_card(self, token, info):
+        """Build the token info message and its quick action buttons"""
+        parts = [
+            f"🪙 *{info['name'] or 'Unknown'}* ({info['symbol'] or 'N/A'})\n\n",
+            f"📍 Address: `{token[:8]}...{token[-8:]}`\n"
+        ]
         
         # Show price source and timestamp
         if info['dex_name']:
-            response += f"🔄 Source: {info['dex_name']}\n"
+            parts.append(f"🔄 Source: {info['dex_name']}\n")
         if info['price_timestamp']:
-            response += f"⏰ Updated: {info['price_timestamp'].strftime('%H:%M:%S')}\n"
-        response += "\n"
+            parts.append(f"⏰ Updated: {info['price_timestamp'].strftime('%H:%M:%S')}\n")
+        parts.append("\n")
         
-        response += f"💵 *Price:* {info['price']:.9f} SOL (~${info['price_usd']:.4f})\n"
+        parts.append(f"💵 *Price:* {info['price']:.9f} SOL (~${info['price_usd']:.4f})\n")
         
         if info['price_change_24h']:
             change_emoji = "📈" if float(info['price_change_24h']) > 0 else "📉"
-            response += f"{change_emoji} *24h Change:* {float(info['price_change_24h']):.2f}%\n"
+            parts.append(f"{change_emoji} *24h Change:* {float(info['price_change_24h']):.2f}%\n")
         
         if info['market_cap']:
-            response += f"💎 *Market Cap:* ${float(info['market_cap']):,.0f}\n"
+            parts.append(f"💎 *Market Cap:* ${float(info['market_cap']):,.0f}\n")
         
         if info['liquidity']:
-            response += f"💧 *Liquidity:* ${float(info['liquidity']):,.0f}\n"
+            parts.append(f"💧 *Liquidity:* ${float(info['liquidity']):,.0f}\n")
         
         if info['volume_24h']:
-            response += f"📊 *24h Volume:* ${float(info['volume_24h']):,.0f}\n"
+            parts.append(f"📊 *24h Volume:* ${float(info['volume_24h']):,.0f}\n")
         
         if info['created_at']:
             age = datetime.now() - info['created_at']
             if age.days > 0:
-                response += f"🎂 *Age:* {age.days} days\n"
+                parts.append(f"🎂 *Age:* {age.days} days\n")
             else:
                 hours = age.seconds // 3600
-                response += f"🎂 *Age:* {hours} hours (NEW!)\n"
+                parts.append(f"🎂 *Age:* {hours} hours (NEW!)\n")
         
-        response += f"\n🔗 [DexScreener](https://dexscreener.com/solana/{token})"
-        response += f" | [Birdeye](https://birdeye.so/token/{token})"
+        parts.append(f"\n🔗 [DexScreener](https://dexscreener.com/solana/{token})")
+        parts.append(f" | [Birdeye](https://birdeye.so/token/{token})")
         
-        # Add quick action buttons
-        keyboard = [
-            [
-                InlineKeyboardButton("🔄 Refresh Price", callback_data=f"refresh_{token}"),
-            ],
-            [
-                InlineKeyboardButton("📈 Buy 0.5 SOL", callback_data=f"qbuy_{token}_0.5"),
-                InlineKeyboardButton("📈 Buy 1.0 SOL", callback_data=f"qbuy_{token}_1.0")
-            ],
-            [
-                InlineKeyboardButton("⭐ Add to Watchlist", callback_data=f"watch_{token}")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        return ''.join(parts), info_keyboard(token)
+    
+    async def info_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Detailed token information"""
+        await self.log_activity(update, "info")
+        if not context.args:
+            await update.message.reply_text("Usage: /info <token_address>")
+            return
+        
+        token = context.args[0]
+        msg = await update.message.reply_text("🔍 Fetching token info...")
+        
+        info = await self.get_token_info(token)
+        
+        if not info['price']:
+            await msg.edit_text("❌ Token not found or invalid address")
+            return
         
+        response, reply_markup = self._format_info_card(token, info)
         await msg.edit_text(response, parse_mode='Markdown', reply_markup=reply_markup, disable_web_page_preview=True)
     
     async def handle_address_paste(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -404,7 +1010,7 @@ class PaperTradingBot:
         text = update.message.text.strip()
         
         # Check if it looks like a Solana address (base58, 32-44 chars)
-        if len(text) >= 32 and len(text) <= 44 and text.isalnum():
+        if ADDRESS_RE.fullmatch(text):
             # Likely a token address, show info automatically
             context.args = [text]
             await self.info_command(update, context)
@@ -430,55 +1036,7 @@ class PaperTradingBot:
                 return
             
             # Rebuild the message with updated price
-            response = f"🪙 *{info['name'] or 'Unknown'}* ({info['symbol'] or 'N/A'})\n\n"
-            response += f"📍 Address: `{token[:8]}...{token[-8:]}`\n"
-            
-            if info['dex_name']:
-                response += f"🔄 Source: {info['dex_name']}\n"
-            if info['price_timestamp']:
-                response += f"⏰ Updated: {info['price_timestamp'].strftime('%H:%M:%S')}\n"
-            response += "\n"
-            
-            response += f"💵 *Price:* {info['price']:.9f} SOL (~${info['price_usd']:.4f})\n"
-            
-            if info['price_change_24h']:
-                change_emoji = "📈" if float(info['price_change_24h']) > 0 else "📉"
-                response += f"{change_emoji} *24h Change:* {float(info['price_change_24h']):.2f}%\n"
-            
-            if info['market_cap']:
-                response += f"💎 *Market Cap:* ${float(info['market_cap']):,.0f}\n"
-            
-            if info['liquidity']:
-                response += f"💧 *Liquidity:* ${float(info['liquidity']):,.0f}\n"
-            
-            if info['volume_24h']:
-                response += f"📊 *24h Volume:* ${float(info['volume_24h']):,.0f}\n"
-            
-            if info['created_at']:
-                age = datetime.now() - info['created_at']
-                if age.days > 0:
-                    response += f"🎂 *Age:* {age.days} days\n"
-                else:
-                    hours = age.seconds // 3600
-                    response += f"🎂 *Age:* {hours} hours (NEW!)\n"
-            
-            response += f"\n🔗 [DexScreener](https://dexscreener.com/solana/{token})"
-            response += f" | [Birdeye](https://birdeye.so/token/{token})"
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton("🔄 Refresh Price", callback_data=f"refresh_{token}"),
-                ],
-                [
-                    InlineKeyboardButton("📈 Buy 0.5 SOL", callback_data=f"qbuy_{token}_0.5"),
-                    InlineKeyboardButton("📈 Buy 1.0 SOL", callback_data=f"qbuy_{token}_1.0")
-                ],
-                [
-                    InlineKeyboardButton("⭐ Add to Watchlist", callback_data=f"watch_{token}")
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
+            response, reply_markup = self._format_info_card(token, info)
             await query.edit_message_text(response, parse_mode='Markdown', reply_markup=reply_markup, disable_web_page_preview=True)
             return
         
@@ -528,25 +1086,27 @@ class PaperTradingBot:
                 }
             
             # Record trade
-            portfolio['history'].append({
+            self.record_trade(user_id, {
                 'type': 'BUY',
                 'token': token,
                 'amount': tokens,
                 'price': exec_price,
                 'value_sol': amount,
                 'dex': info.get('dex_name', 'Unknown'),
-                'timestamp': datetime.now().isoformat()
+                'timestamp': self._now_iso()
             })
             
             await self.log_activity(update, "quick_buy")
-            await self.save_data()
             
-            response = f"✅ *Bought {tokens:.2f} {info['symbol'] or 'tokens'}*\n\n"
-            response += f"💵 Price: {exec_price:.9f} SOL (Slip: {slippage_hit:.2f}%)\n"
-            if info.get('dex_name'):
-                response += f"🔄 Source: {info['dex_name']}\n"
-            response += f"💰 Spent: {amount:.4f} SOL\n"
-            response += f"💰 New Balance: {portfolio['balance']:.4f} SOL"
+            response = BUY_TEMPLATE.format(
+                tokens=tokens,
+                symbol=info['symbol'] or 'tokens',
+                price=exec_price,
+                slippage=slippage_hit,
+                source=f"🔄 Source: {info['dex_name']}\n" if info.get('dex_name') else "",
+                spent=amount,
+                balance=portfolio['balance']
+            )
             
             await query.edit_message_text(response, parse_mode='Markdown')
         
@@ -558,7 +1118,7 @@ class PaperTradingBot:
                 watchlists[user_id].append(token)
                 await query.edit_message_text(f"⭐ Added to watchlist!\n\nUse /watchlist to see all watched tokens")
                 await self.log_activity(update, "watch_click")
-                await self.save_data()
+                self.mark_dirty(user_id, 'watchlists')
             else:
                 await query.edit_message_text("Already in your watchlist!")
     
@@ -594,18 +1154,17 @@ class PaperTradingBot:
             portfolios[user_id] = {
                 'balance': self.starting_balance,
                 'positions': {},
-                'history': []
+                'history': deque(maxlen=self.history_limit)
             }
-            await self.save_data()
+            self.mark_dirty(user_id, 'portfolios')
         
         if len(context.args) < 2:
             await update.message.reply_text("Usage: /buy <token_address> <sol_amount>")
             return
         
         token = context.args[0]
-        try:
-            sol_amount = float(context.args[1])
-        except:
+        sol_amount = try_float(context.args[1])
+        if sol_amount is None:
             await update.message.reply_text("❌ Invalid amount")
             return
         
@@ -647,22 +1206,25 @@ class PaperTradingBot:
             }
         
         # Record trade
-        portfolio['history'].append({
+        self.record_trade(user_id, {
             'type': 'BUY',
             'token': token,
             'amount': tokens,
             'price': exec_price,
             'value_sol': sol_amount,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': self._now_iso()
         })
         
-        await self.save_data()
-        
         await update.message.reply_text(
-            f"✅ *Bought {tokens:.2f} {info['symbol'] or 'tokens'}*\n\n"
-            f"💵 Price: {exec_price:.9f} SOL (Slip: {slippage_hit:.2f}%)\n"
-            f"💰 Spent: {sol_amount:.4f} SOL\n"
-            f"💰 New Balance: {portfolio['balance']:.4f} SOL",
+            BUY_TEMPLATE.format(
+                tokens=tokens,
+                symbol=info['symbol'] or 'tokens',
+                price=exec_price,
+                slippage=slippage_hit,
+                source="",
+                spent=sol_amount,
+                balance=portfolio['balance']
+            ),
             parse_mode='Markdown'
         )
     
@@ -689,9 +1251,8 @@ class PaperTradingBot:
         if context.args[1].lower() == 'all':
             amount = portfolio['positions'][token]['amount']
         else:
-            try:
-                amount = float(context.args[1])
-            except:
+            amount = try_float(context.args[1])
+            if amount is None:
                 await update.message.reply_text("❌ Invalid amount")
                 return
         
@@ -717,31 +1278,36 @@ class PaperTradingBot:
         
         # Update portfolio
         portfolio['balance'] += sol_amount
-        portfolio['positions'][token]['amount'] -= amount
+        pos = portfolio['positions'][token]
+        pos['amount'] -= amount
         
-        if portfolio['positions'][token]['amount'] < 0.0001:
-            del portfolio['positions'][token]
+        if pos['amount'] < 0.0001:
+            portfolio['positions'].pop(token, None)
         
         # Record trade
-        portfolio['history'].append({
+        self.record_trade(user_id, {
             'type': 'SELL',
             'token': token,
             'amount': amount,
             'price': exec_price,
             'value_sol': sol_amount,
             'profit': profit,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': self._now_iso()
         })
         
-        await self.save_data()
-        
         profit_emoji = "📈" if profit > 0 else "📉"
         await update.message.reply_text(
-            f"✅ *Sold {amount:.2f} {info['symbol'] or 'tokens'}*\n\n"
-            f"💵 Price: {exec_price:.9f} SOL (Slip: {slippage_hit:.2f}%)\n"
-            f"💰 Received: {sol_amount:.4f} SOL\n"
-            f"{profit_emoji} *P/L:* {profit:.4f} SOL ({profit_pct:+.2f}%)\n"
-            f"💰 New Balance: {portfolio['balance']:.4f} SOL",
+            SELL_TEMPLATE.format(
+                amount=amount,
+                symbol=info['symbol'] or 'tokens',
+                price=exec_price,
+                slippage=slippage_hit,
+                received=sol_amount,
+                profit_emoji=profit_emoji,
+                profit=profit,
+                profit_pct=profit_pct,
+                balance=portfolio['balance']
+            ),
             parse_mode='Markdown'
         )
     
@@ -753,66 +1319,88 @@ class PaperTradingBot:
             await update.message.reply_text("You don't have a portfolio yet. Use /start")
             return
         
+        msg, reply_markup = await self._render_portfolio(user_id)
+        await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=reply_markup)
+    
+    async def _render_portfolio(self, user_id):
+        """Portfolio message and position buttons, reused for RENDER_CACHE_TTL seconds"""
+        cached = self.render_cache.get(user_id)
+        if cached is not None:
+            return cached
+        
+        # Snapshot cash and positions together (positions are updated in place on trades),
+        # so a trade made while prices load can't mix old and new state in one view
         portfolio = portfolios[user_id]
+        version = self.portfolio_versions.get(user_id)
+        balance = portfolio['balance']
+        positions = tuple((token, pos.copy()) for token, pos in portfolio['positions'].items())
+        infos = await self._fetch_infos(token for token, _ in positions)
+        header = f"📊 *Your Portfolio*\n\n💰 Cash: {balance:.4f} SOL\n\n"
+        
+        if not positions:
+            rendered = (header + "No positions", None)
+        else:
+            rendered = self._portfolio_view(balance, positions, header, infos)
+        # Don't cache a view if the portfolio changed while it was being built
+        if self.portfolio_versions.get(user_id) == version:
+            self.render_cache[user_id] = rendered
+        return rendered
+    
+    def _portfolio_view(self, balance, positions, header, infos):
+        """Portfolio message body with a button per position"""
+        total_value = balance
+        parts = [header, "*Positions:*\n"]
         
-        msg = f"📊 *Your Portfolio*\n\n💰 Cash: {portfolio['balance']:.4f} SOL\n\n"
+        # Create buttons for each position
+        keyboard = []
         
-        if not portfolio['positions']:
-            msg += "No positions"
-            await update.message.reply_text(msg, parse_mode='Markdown')
-        else:
-            total_value = portfolio['balance']
-            msg += "*Positions:*\n"
+        for token, pos in positions:
+            price = infos[token]['price']
+            symbol = pos.get('symbol', 'N/A')
             
-            # Create buttons for each position
-            keyboard = []
+            if not price:
+                continue
             
-            for token, pos in portfolio['positions'].items():
-                info = await self.get_token_info(token)
-                price = info['price']
-                symbol = pos.get('symbol', 'N/A')
-                
-                if not price:
-                    continue
-                
-                value = pos['amount'] * price
-                profit = (price - pos['avg_price']) * pos['amount']
-                profit_pct = ((price / pos['avg_price']) - 1) * 100
-                total_value += value
-                
-                profit_emoji = "📈" if profit > 0 else "📉"
-                msg += (
-                    f"\n🪙 *{symbol}*\n"
-                    f"   Amount: {pos['amount']:.2f}\n"
-                    f"   Avg: {pos['avg_price']:.9f} SOL\n"
-                    f"   Now: {price:.9f} SOL\n"
-                    f"   Value: {value:.4f} SOL\n"
-                    f"   {profit_emoji} P/L: {profit:.4f} SOL ({profit_pct:+.2f}%)\n"
-                )
-                
-                # Add button for this position
-                keyboard.append([
-                    InlineKeyboardButton(f"🎯 {symbol} Actions", callback_data=f"pos_{token}")
-                ])
+            amount, avg_price = pos['amount'], pos['avg_price']
+            value = amount * price
+            profit = value - amount * avg_price
+            profit_pct = (price / avg_price - 1) * 100
+            total_value += value
             
-            total_profit = total_value - self.starting_balance
-            total_pct = ((total_value / self.starting_balance) - 1) * 100
-            msg += f"\n💼 *Total Value:* {total_value:.4f} SOL\n"
-            msg += f"📊 *Total P/L:* {total_profit:.4f} SOL ({total_pct:+.2f}%)"
+            profit_emoji = "📈" if profit > 0 else "📉"
+            parts.append(
+                f"\n🪙 *{symbol}*\n"
+                f"   Amount: {amount:.2f}\n"
+                f"   Avg: {avg_price:.9f} SOL\n"
+                f"   Now: {price:.9f} SOL\n"
+                f"   Value: {value:.4f} SOL\n"
+                f"   {profit_emoji} P/L: {profit:.4f} SOL ({profit_pct:+.2f}%)\n"
+            )
             
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=reply_markup)
+            # Add button for this position
+            keyboard.append([
+                InlineKeyboardButton(f"🎯 {symbol} Actions", callback_data=f"pos_{token}")
+            ])
+        
+        total_profit = total_value - self.starting_balance
+        total_pct = ((total_value / self.starting_balance) - 1) * 100
+        parts.append(f"\n💼 *Total Value:* {total_value:.4f} SOL\n")
+        parts.append(f"📊 *Total P/L:* {total_profit:.4f} SOL ({total_pct:+.2f}%)")
+        
+        return ''.join(parts), InlineKeyboardMarkup(keyboard)
     
     async def position_actions(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show detailed actions for a specific position"""
         query = update.callback_query
         await query.answer()
         
-        data = query.data.split('_')
-        if data[0] != 'pos':
+        prefix, _, token = query.data.partition('_')
+        if prefix != 'pos':
             return
-        
-        token = data[1]
+        await self._show_position(query, token)
+    
+    async def _show_position(self, query, token):
+        """Render the position detail screen for the user who pressed the button"""
         user_id = query.from_user.id
         
         if user_id not in portfolios or token not in portfolios[user_id]['positions']:
@@ -837,25 +1425,31 @@ class PaperTradingBot:
         
         profit_emoji = "📈" if profit > 0 else "📉"
         
-        # Build message
-        msg = f"🪙 *{pos.get('symbol', 'Token')} Position*\n\n"
-        msg += f"📊 *Holdings:* {pos['amount']:.2f}\n"
-        msg += f"💰 *Value:* {value:.4f} SOL (~${value * info.get('sol_price', 0):.2f})\n\n"
-        msg += f"📍 *Entry Price:* {pos['avg_price']:.9f} SOL\n"
-        msg += f"💵 *Current Price:* {price:.9f} SOL\n"
-        
+        # Optional lines, only when the price source provides them
+        source = ""
         if info.get('dex_name'):
-            msg += f"🔄 *Source:* {info['dex_name']}\n"
+            source += f"🔄 *Source:* {info['dex_name']}\n"
         if info.get('price_timestamp'):
-            msg += f"⏰ *Updated:* {info['price_timestamp'].strftime('%H:%M:%S')}\n"
-        
-        msg += f"\n{profit_emoji} *Unrealized P/L:*\n"
-        msg += f"   {profit:.4f} SOL ({profit_pct:+.2f}%)\n"
-        
-        # Add price change if available
+            source += f"⏰ *Updated:* {info['price_timestamp'].strftime('%H:%M:%S')}\n"
+        change = ""
         if info.get('price_change_24h'):
-            change_emoji = "📈" if float(info['price_change_24h']) > 0 else "📉"
-            msg += f"\n{change_emoji} *24h Change:* {float(info['price_change_24h']):.2f}%"
+            change_24h = float(info['price_change_24h'])
+            change_emoji = "📈" if change_24h > 0 else "📉"
+            change = f"\n{change_emoji} *24h Change:* {change_24h:.2f}%"
+        
+        msg = POSITION_TEMPLATE.format(
+            symbol=pos.get('symbol', 'Token'),
+            amount=pos['amount'],
+            value=value,
+            value_usd=value * info.get('sol_price', 0),
+            avg_price=pos['avg_price'],
+            price=price,
+            source=source,
+            profit_emoji=profit_emoji,
+            profit=profit,
+            profit_pct=profit_pct,
+            change=change
+        )
         
         # Create action buttons
         keyboard = [
@@ -888,201 +1482,151 @@ class PaperTradingBot:
         query = update.callback_query
         await query.answer()
         
-        data = query.data.split('_')
-        action = data[0]
-        
-        # Handle back to portfolio
-        if query.data == "back_portfolio":
-            user_id = query.from_user.id
-            if user_id not in portfolios:
-                await query.edit_message_text("Portfolio not found")
-                return
-            
-            # Recreate portfolio view
-            portfolio = portfolios[user_id]
-            msg = f"📊 *Your Portfolio*\n\n💰 Cash: {portfolio['balance']:.4f} SOL\n\n"
-            
-            if not portfolio['positions']:
-                msg += "No positions"
-                await query.edit_message_text(msg, parse_mode='Markdown')
-                return
-            
-            total_value = portfolio['balance']
-            msg += "*Positions:*\n"
-            keyboard = []
-            
-            for token, pos in portfolio['positions'].items():
-                info = await self.get_token_info(token)
-                price = info['price']
-                symbol = pos.get('symbol', 'N/A')
-                
-                if not price:
-                    continue
-                
-                value = pos['amount'] * price
-                profit = (price - pos['avg_price']) * pos['amount']
-                profit_pct = ((price / pos['avg_price']) - 1) * 100
-                total_value += value
-                
-                profit_emoji = "📈" if profit > 0 else "📉"
-                msg += (
-                    f"\n🪙 *{symbol}*\n"
-                    f"   Amount: {pos['amount']:.2f}\n"
-                    f"   Avg: {pos['avg_price']:.9f} SOL\n"
-                    f"   Now: {price:.9f} SOL\n"
-                    f"   Value: {value:.4f} SOL\n"
-                    f"   {profit_emoji} P/L: {profit:.4f} SOL ({profit_pct:+.2f}%)\n"
-                )
-                
-                keyboard.append([
-                    InlineKeyboardButton(f"🎯 {symbol} Actions", callback_data=f"pos_{token}")
-                ])
-            
-            total_profit = total_value - self.starting_balance
-            total_pct = ((total_value / self.starting_balance) - 1) * 100
-            msg += f"\n💼 *Total Value:* {total_value:.4f} SOL\n"
-            msg += f"📊 *Total P/L:* {total_profit:.4f} SOL ({total_pct:+.2f}%)"
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(msg, parse_mode='Markdown', reply_markup=reply_markup)
-            return
-        
-        token = data[1]
+        action, _, rest = query.data.partition('_')
+        token, _, arg = rest.partition('_')
         user_id = query.from_user.id
         
         if user_id not in portfolios:
             await query.edit_message_text("Portfolio not found")
             return
         
-        # Handle refresh
-        if action == "posrefresh":
-            await self.position_actions(update, context)
+        handler = self.position_callbacks.get(action)
+        if handler:
+            await handler(query, user_id, token, arg)
+    
+    async def _position_back(self, query, user_id, token, arg):
+        """Return from the position screen to the portfolio view (back_portfolio)"""
+        msg, reply_markup = await self._render_portfolio(user_id)
+        await query.edit_message_text(msg, parse_mode='Markdown', reply_markup=reply_markup)
+    
+    async def _position_refresh(self, query, user_id, token, arg):
+        """Re-render the position screen with a fresh price"""
+        await self._show_position(query, token)
+    
+    async def _position_chart(self, query, user_id, token, arg):
+        """Replace the position screen with chart links"""
+        await query.edit_message_text(
+            f"📈 *Chart Links:*\n\n"
+            f"🦅 [Birdeye](https://birdeye.so/token/{token}?chain=solana)\n"
+            f"📊 [DexScreener](https://dexscreener.com/solana/{token})\n"
+            f"🔥 [DexTools](https://www.dextools.io/app/en/solana/pair-explorer/{token})\n\n"
+            f"Click refresh on your position to go back",
+            parse_mode='Markdown',
+            disable_web_page_preview=True
+        )
+    
+    async def _position_buy(self, query, user_id, token, arg):
+        """Buy more of a held token for a fixed SOL amount"""
+        amount = float(arg)
+        portfolio = portfolios[user_id]
+        
+        if amount > portfolio['balance']:
+            await query.edit_message_text(f"❌ Insufficient balance! You have {portfolio['balance']:.4f} SOL")
             return
         
-        # Handle chart
-        if action == "poschart":
-            await query.edit_message_text(
-                f"📈 *Chart Links:*\n\n"
-                f"🦅 [Birdeye](https://birdeye.so/token/{token}?chain=solana)\n"
-                f"📊 [DexScreener](https://dexscreener.com/solana/{token})\n"
-                f"🔥 [DexTools](https://www.dextools.io/app/en/solana/pair-explorer/{token})\n\n"
-                f"Click refresh on your position to go back",
-                parse_mode='Markdown',
-                disable_web_page_preview=True
-            )
+        info = await self.get_token_info(token)
+        price = info['price']
+        
+        if not price:
+            await query.edit_message_text("❌ Could not fetch price")
             return
         
-        # Handle buy more
-        if action == "posbuy":
-            amount = float(data[2])
-            portfolio = portfolios[user_id]
-            
-            if amount > portfolio['balance']:
-                await query.edit_message_text(f"❌ Insufficient balance! You have {portfolio['balance']:.4f} SOL")
-                return
-            
-            info = await self.get_token_info(token)
-            price = info['price']
-            
-            if not price:
-                await query.edit_message_text("❌ Could not fetch price")
-                return
-            
-            # Apply slippage
-            exec_price, slippage_hit = self.apply_slippage(price, True, user_id)
-            tokens = amount / exec_price
-            
-            # Update position
-            old_tokens = portfolio['positions'][token]['amount']
-            old_avg = portfolio['positions'][token]['avg_price']
-            new_total = old_tokens + tokens
-            new_avg = ((old_tokens * old_avg) + (tokens * exec_price)) / new_total
-            
-            portfolio['balance'] -= amount
-            portfolio['positions'][token]['amount'] = new_total
-            portfolio['positions'][token]['avg_price'] = new_avg
-            
-            # Record trade
-            portfolio['history'].append({
-                'type': 'BUY',
-                'token': token,
-                'amount': tokens,
-                'price': exec_price,
-                'value_sol': amount,
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            await self.save_data()
-            
-            await query.edit_message_text(
-                f"✅ *Bought {tokens:.2f} more!*\n\n"
-                f"💵 Price: {exec_price:.9f} SOL (Slip: {slippage_hit:.2f}%)\n"
-                f"💰 Spent: {amount:.4f} SOL\n"
-                f" New Position: {new_total:.2f}\n"
-                f"📍 New Avg: {new_avg:.9f} SOL\n"
-                f"💰 Balance: {portfolio['balance']:.4f} SOL\n\n"
-                f"Use /portfolio to see updated positions",
-                parse_mode='Markdown'
-            )
+        # Apply slippage
+        exec_price, slippage_hit = self.apply_slippage(price, True, user_id)
+        tokens = amount / exec_price
+        
+        # Update position
+        old_tokens = portfolio['positions'][token]['amount']
+        old_avg = portfolio['positions'][token]['avg_price']
+        new_total = old_tokens + tokens
+        new_avg = ((old_tokens * old_avg) + (tokens * exec_price)) / new_total
+        
+        portfolio['balance'] -= amount
+        portfolio['positions'][token]['amount'] = new_total
+        portfolio['positions'][token]['avg_price'] = new_avg
+        
+        # Record trade
+        self.record_trade(user_id, {
+            'type': 'BUY',
+            'token': token,
+            'amount': tokens,
+            'price': exec_price,
+            'value_sol': amount,
+            'timestamp': self._now_iso()
+        })
+        
+        await query.edit_message_text(
+            POSITION_BUY_TEMPLATE.format(
+                tokens=tokens,
+                price=exec_price,
+                slippage=slippage_hit,
+                spent=amount,
+                position=new_total,
+                avg_price=new_avg,
+                balance=portfolio['balance']
+            ),
+            parse_mode='Markdown'
+        )
+    
+    async def _position_sell(self, query, user_id, token, arg):
+        """Sell a percentage of a position"""
+        percentage = float(arg)
+        portfolio = portfolios[user_id]
+        
+        if token not in portfolio['positions']:
+            await query.edit_message_text("Position not found")
             return
         
-        # Handle sell percentage
-        if action == "possell":
-            percentage = float(data[2])
-            portfolio = portfolios[user_id]
-            
-            if token not in portfolio['positions']:
-                await query.edit_message_text("Position not found")
-                return
-            
-            pos = portfolio['positions'][token]
-            amount = pos['amount'] * (percentage / 100)
-            
-            info = await self.get_token_info(token)
-            price = info['price']
-            
-            if not price:
-                await query.edit_message_text("❌ Could not fetch price")
-                return
-            
-            # Apply slippage
-            exec_price, slippage_hit = self.apply_slippage(price, False, user_id)
-            sol_amount = amount * exec_price
-            profit = (exec_price - pos['avg_price']) * amount
-            profit_pct = ((exec_price / pos['avg_price']) - 1) * 100
-            
-            # Update portfolio
-            portfolio['balance'] += sol_amount
-            portfolio['positions'][token]['amount'] -= amount
-            
-            # Remove position if sold all
-            if portfolio['positions'][token]['amount'] < 0.0001:
-                del portfolio['positions'][token]
-            
-            # Record trade
-            portfolio['history'].append({
-                'type': 'SELL',
-                'token': token,
-                'amount': amount,
-                'price': exec_price,
-                'value_sol': sol_amount,
-                'profit': profit,
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            await self.save_data()
-            
-            profit_emoji = "📈" if profit > 0 else "📉"
-            await query.edit_message_text(
-                f"✅ *Sold {percentage:.0f}% ({amount:.2f} tokens)*\n\n"
-                f"💵 Price: {exec_price:.9f} SOL (Slip: {slippage_hit:.2f}%)\n"
-                f"💰 Received: {sol_amount:.4f} SOL\n"
-                f"{profit_emoji} *P/L:* {profit:.4f} SOL ({profit_pct:+.2f}%)\n"
-                f"💰 New Balance: {portfolio['balance']:.4f} SOL\n\n"
-                f"Use /portfolio to see updated positions",
-                parse_mode='Markdown'
-            )
+        pos = portfolio['positions'][token]
+        amount = pos['amount'] * (percentage / 100)
+        
+        info = await self.get_token_info(token)
+        price = info['price']
+        
+        if not price:
+            await query.edit_message_text("❌ Could not fetch price")
             return
+        
+        # Apply slippage
+        exec_price, slippage_hit = self.apply_slippage(price, False, user_id)
+        sol_amount = amount * exec_price
+        profit = (exec_price - pos['avg_price']) * amount
+        profit_pct = ((exec_price / pos['avg_price']) - 1) * 100
+        
+        # Update portfolio
+        portfolio['balance'] += sol_amount
+        pos['amount'] -= amount
+        
+        # Remove position if sold all
+        if pos['amount'] < 0.0001:
+            portfolio['positions'].pop(token, None)
+        
+        # Record trade
+        self.record_trade(user_id, {
+            'type': 'SELL',
+            'token': token,
+            'amount': amount,
+            'price': exec_price,
+            'value_sol': sol_amount,
+            'profit': profit,
+            'timestamp': self._now_iso()
+        })
+        
+        profit_emoji = "📈" if profit > 0 else "📉"
+        await query.edit_message_text(
+            POSITION_SELL_TEMPLATE.format(
+                percentage=percentage,
+                amount=amount,
+                price=exec_price,
+                slippage=slippage_hit,
+                received=sol_amount,
+                profit_emoji=profit_emoji,
+                profit=profit,
+                profit_pct=profit_pct,
+                balance=portfolio['balance']
+            ),
+            parse_mode='Markdown'
+        )
     
     async def watchlist_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
@@ -1091,19 +1635,19 @@ class PaperTradingBot:
             await update.message.reply_text("⭐ Your watchlist is empty!\n\nUse /watch <token> to add tokens")
             return
         
-        msg = "⭐ *Your Watchlist*\n\n"
+        parts = ["⭐ *Your Watchlist*\n\n"]
+        infos = await self._fetch_infos(watchlists[user_id])
         
-        for token in watchlists[user_id]:
-            info = await self.get_token_info(token)
+        for info in infos.values():
             if info['price']:
                 symbol = info['symbol'] or 'Unknown'
                 change = info['price_change_24h'] or 0
                 change_emoji = "📈" if float(change) > 0 else "📉"
                 
-                msg += f"🪙 *{symbol}*\n"
-                msg += f"   {info['price']:.9f} SOL {change_emoji} {float(change):.2f}%\n\n"
+                parts.append(f"🪙 *{symbol}*\n")
+                parts.append(f"   {info['price']:.9f} SOL {change_emoji} {float(change):.2f}%\n\n")
         
-        await update.message.reply_text(msg, parse_mode='Markdown')
+        await update.message.reply_text(''.join(parts), parse_mode='Markdown')
     
     async def watch_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not context.args:
@@ -1122,7 +1666,7 @@ class PaperTradingBot:
         
         watchlists[user_id].append(token)
         info = await self.get_token_info(token)
-        await self.save_data()
+        self.mark_dirty(user_id, 'watchlists')
         
         await update.message.reply_text(
             f"⭐ Added *{info['symbol'] or 'token'}* to watchlist!\n\n"
@@ -1137,43 +1681,41 @@ class PaperTradingBot:
             await update.message.reply_text("No trading history yet!")
             return
         
-        portfolio = portfolios[user_id]
-        history = portfolio['history']
-        
-        total_trades = len(history)
-        buys = [t for t in history if t['type'] == 'BUY']
-        sells = [t for t in history if t['type'] == 'SELL']
+        portfolio = self._trade_totals(portfolios[user_id])
         
-        winning_trades = [t for t in sells if t.get('profit', 0) > 0]
-        losing_trades = [t for t in sells if t.get('profit', 0) < 0]
+        total_trades = portfolio['n_buys'] + portfolio['n_sells']
+        sells = portfolio['n_sells']
+        win_rate = (portfolio['n_wins'] / sells * 100) if sells else 0
         
-        total_profit = sum(t.get('profit', 0) for t in sells)
-        win_rate = (len(winning_trades) / len(sells) * 100) if sells else 0
-        
-        msg = f"📊 *Your Trading Stats*\n\n"
-        msg += f"📈 Total Trades: {total_trades}\n"
-        msg += f"🟢 Buys: {len(buys)}\n"
-        msg += f"🔴 Sells: {len(sells)}\n\n"
+        parts = [
+            "📊 *Your Trading Stats*\n\n",
+            f"📈 Total Trades: {total_trades}\n",
+            f"🟢 Buys: {portfolio['n_buys']}\n",
+            f"🔴 Sells: {sells}\n\n"
+        ]
         
         if sells:
-            msg += f"✅ Winning Trades: {len(winning_trades)}\n"
-            msg += f"❌ Losing Trades: {len(losing_trades)}\n"
-            msg += f"🎯 Win Rate: {win_rate:.1f}%\n\n"
-            msg += f"💰 Total Realized P/L: {total_profit:.4f} SOL\n"
+            parts.append(f"✅ Winning Trades: {portfolio['n_wins']}\n")
+            parts.append(f"❌ Losing Trades: {portfolio['n_losses']}\n")
+            parts.append(f"🎯 Win Rate: {win_rate:.1f}%\n\n")
+            parts.append(f"💰 Total Realized P/L: {portfolio['realized_pnl']:.4f} SOL\n")
         
         # Current portfolio value
         total_value = portfolio['balance']
-        for token, pos in portfolio['positions'].items():
-            info = await self.get_token_info(token)
+        # Snapshot first: a trade during the price fetch must not change what gets priced
+        positions = tuple(portfolio['positions'].items())
+        infos = await self._fetch_infos(token for token, _ in positions)
+        for token, pos in positions:
+            info = infos[token]
             if info['price']:
                 total_value += pos['amount'] * info['price']
         
         overall_pl = total_value - self.starting_balance
         overall_pct = ((total_value / self.starting_balance) - 1) * 100
         
-        msg += f"\n📊 Overall P/L: {overall_pl:.4f} SOL ({overall_pct:+.2f}%)"
+        parts.append(f"\n📊 Overall P/L: {overall_pl:.4f} SOL ({overall_pct:+.2f}%)")
         
-        await update.message.reply_text(msg, parse_mode='Markdown')
+        await update.message.reply_text(''.join(parts), parse_mode='Markdown')
     
     async def leaderboard(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not portfolios:
@@ -1189,37 +1731,37 @@ class PaperTradingBot:
             
         # Fetch prices in parallel
         token_prices = {}
-        tasks = [self.get_token_info(token) for token in all_tokens]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        for token, result in zip(all_tokens, results):
-            if isinstance(result, dict) and result.get('price'):
-                token_prices[token] = result['price']
+        infos = await self._fetch_infos(all_tokens)
         
-        leaderboard_data = []
+        for token, info in infos.items():
+            if info['price']:
+                token_prices[token] = info['price']
+        
+        # Flatten every position into (trader index, amount, price) arrays and
+        # sum position values per trader in one pass
+        user_ids = list(portfolios)
+        balances = np.fromiter((data['balance'] for data in portfolios.values()), dtype=np.float64, count=len(user_ids))
+        positions = [
+            (idx, pos['amount'], token_prices.get(token, pos['avg_price']))
+            for idx, data in enumerate(portfolios.values())
+            for token, pos in data['positions'].items()
+        ]
+        idx = np.fromiter((p[0] for p in positions), dtype=np.int64, count=len(positions))
+        amounts = np.fromiter((p[1] for p in positions), dtype=np.float64, count=len(positions))
+        prices = np.fromiter((p[2] for p in positions), dtype=np.float64, count=len(positions))
+        equity, pnl_pct = compute_equity(balances, idx, amounts, prices, self.starting_balance)
         
-        for user_id, data in portfolios.items():
-            total_value = data['balance']
-            
-            for token, pos in data['positions'].items():
-                price = token_prices.get(token, pos['avg_price'])
-                total_value += pos['amount'] * price
-            
-            leaderboard_data.append({
-                'user_id': user_id,
-                'equity': total_value,
-                'pnl_pct': ((total_value / self.starting_balance) - 1) * 100
-            })
-            
-        leaderboard_data.sort(key=lambda x: x['equity'], reverse=True)
+        # Only the top 10 need ordering: partition them out, then sort those
+        top = np.argpartition(-equity, min(10, len(equity)) - 1)[:10]
+        top = top[np.argsort(-equity[top], kind='stable')]
         
-        text = "🏆 *Top Traders Leaderboard*\n\n"
-        for i, trader in enumerate(leaderboard_data[:10], 1):
+        parts = ["🏆 *Top Traders Leaderboard*\n\n"]
+        for i, j in enumerate(top, 1):
             medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-            text += f"{medal} *User {trader['user_id']}*\n"
-            text += f"   💰 {trader['equity']:,.4f} SOL ({trader['pnl_pct']:+.2f}%)\n\n"
+            parts.append(f"{medal} *User {user_ids[j]}*\n")
+            parts.append(f"   💰 {equity[j]:,.4f} SOL ({pnl_pct[j]:+.2f}%)\n\n")
             
-        await msg.edit_text(text, parse_mode='Markdown')
+        await msg.edit_text(''.join(parts), parse_mode='Markdown')
 
     async def history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
@@ -1228,21 +1770,21 @@ class PaperTradingBot:
             await update.message.reply_text("No trade history yet")
             return
         
-        history = portfolios[user_id]['history'][-10:]  # Last 10 trades
+        history = islice(reversed(portfolios[user_id]['history']), 10)  # Last 10 trades, newest first
         
-        msg = "📜 *Trade History* (Last 10)\n\n"
+        parts = ["📜 *Trade History* (Last 10)\n\n"]
         
-        for trade in reversed(history):
+        for trade in history:
             emoji = "🟢" if trade['type'] == 'BUY' else "🔴"
-            msg += f"{emoji} *{trade['type']}*\n"
-            msg += f"   {trade['token'][:8]}...\n"
-            msg += f"   {trade['amount']:.2f} @ {trade['price']:.9f} SOL\n"
+            parts.append(f"{emoji} *{trade['type']}*\n")
+            parts.append(f"   {trade['token'][:8]}...\n")
+            parts.append(f"   {trade['amount']:.2f} @ {trade['price']:.9f} SOL\n")
             if trade['type'] == 'SELL' and 'profit' in trade:
                 pl_emoji = "📈" if trade['profit'] > 0 else "📉"
-                msg += f"   {pl_emoji} P/L: {trade['profit']:.4f} SOL\n"
-            msg += "\n"
+                parts.append(f"   {pl_emoji} P/L: {trade['profit']:.4f} SOL\n")
+            parts.append("\n")
         
-        await update.message.reply_text(msg, parse_mode='Markdown')
+        await update.message.reply_text(''.join(parts), parse_mode='Markdown')
     
     async def chart_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not context.args:
@@ -1265,9 +1807,9 @@ class PaperTradingBot:
         portfolios[user_id] = {
             'balance': self.starting_balance,
             'positions': {},
-            'history': []
+            'history': deque(maxlen=self.history_limit)
         }
-        await self.save_data()
+        self.mark_dirty(user_id, 'portfolios', reset_history=True)
         await update.message.reply_text("✅ Portfolio reset! Starting balance: 10 SOL")
     
     async def fund(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1280,9 +1822,8 @@ class PaperTradingBot:
         if not context.args:
             amount = 1.0  # Default 1 SOL
         else:
-            try:
-                amount = float(context.args[0])
-            except:
+            amount = try_float(context.args[0])
+            if amount is None:
                 await update.message.reply_text("Usage: /fund <amount> (e.g., /fund 5)")
                 return
         
@@ -1291,7 +1832,7 @@ class PaperTradingBot:
             return
         
         portfolios[user_id]['balance'] += amount
-        await self.save_data()
+        self.mark_dirty(user_id, 'portfolios')
         
         await update.message.reply_text(
             f"✅ Added {amount:.4f} SOL to your account!\n"
@@ -1305,7 +1846,7 @@ class PaperTradingBot:
         
         if user_id not in user_settings:
             user_settings[user_id] = {'slippage': 1.0}
-            await self.save_data()
+            self.mark_dirty(user_id, 'user_settings')
             
         settings = user_settings[user_id]
         slippage = settings.get('slippage', 1.0)
@@ -1355,114 +1896,138 @@ class PaperTradingBot:
             user_settings[user_id]['slippage'] = 1.0
             await query.answer("✅ Settings reset to default", show_alert=True)
         elif data.startswith("set_slip_"):
-            try:
-                value = float(data.split('_')[2])
+            value = try_float(data.rpartition('_')[2])
+            if value is not None:
                 user_settings[user_id]['slippage'] = value
                 await query.answer(f"✅ Slippage set to {value}%")
-            except:
-                pass
         
-        await self.save_data()
+        self.mark_dirty(user_id, 'user_settings')
         await self.settings_command(update, context)
         
     async def admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show internal analytics"""
-        user_id = update.effective_user.id
-        admin_id = os.getenv("ADMIN_USER_ID")
-        
         # Security Check: Only allow the admin defined in .env
-        if not admin_id or str(user_id) != str(admin_id):
+        if self.admin_id is None or update.effective_user.id != self.admin_id:
             return  # Silent ignore (don't even reply to unauthorized users)
         
-        total_users = len(user_stats)
-        now = datetime.now()
+        # Activity times are epoch milliseconds, so bucketing is plain number comparisons
+        now = time.time()
+        now_ms = now * 1000
+        # Local midnight, without building datetime objects
+        today_start_ms = time.mktime(time.localtime(now)[:3] + (0, 0, 0, 0, 0, -1)) * 1000
+        day_cutoff = now_ms - DAY_MS
+        week_cutoff = now_ms - 7 * DAY_MS
+        month_cutoff = now_ms - 30 * DAY_MS
         dau = 0
         mau = 0
-        new_today = 0
         active_7d = 0
         
-        top_commands = {}
-        
-        for u in user_stats.values():
-            try:
-                last = datetime.fromisoformat(u['last_active'])
-                joined = datetime.fromisoformat(u['joined_at'])
-                
-                delta = now - last
-                if delta.days < 1:
+        # Most recently active first: only users seen in the last 30 days are visited
+        for last_active in reversed(self.recent_users.values()):
+            if last_active <= month_cutoff:
+                break
+            mau += 1
+            if last_active > week_cutoff:
+                active_7d += 1
+                if last_active > day_cutoff:
                     dau += 1
-                if delta.days < 7:
-                    active_7d += 1
-                if delta.days < 30:
-                    mau += 1
-                
-                if (now - joined).days < 1 and joined.date() == now.date():
-                    new_today += 1
-                
-                for cmd, count in u.get('commands', {}).items():
-                    top_commands[cmd] = top_commands.get(cmd, 0) + count
-            except:
-                continue
-                
-        # Sort commands
-        sorted_cmds = sorted(top_commands.items(), key=lambda x: x[1], reverse=True)[:5]
-        
-        msg = "📊 *Bot Analytics (Admin)*\n\n"
-        msg += f"👥 Total Users: {total_users}\n"
-        msg += f"🆕 New Today: {new_today}\n\n"
-        msg += f"🔥 *Activity:*\n"
-        msg += f"• DAU (24h): {dau}\n"
-        msg += f"• Weekly (7d): {active_7d}\n"
-        msg += f"• MAU (30d): {mau}\n\n"
-        msg += f"⌨️ *Top Commands:*\n"
-        for cmd, count in sorted_cmds:
-            msg += f"• /{cmd}: {count}\n"
-            
+        
+        new_today = len(self.join_times) - bisect_left(self.join_times, today_start_ms)
+        # Escape underscores (quick_buy, watch_click) so Markdown doesn't read them as italics
+        commands = "".join(
+            f"\n• /{cmd}: {count}".replace('_', '\\_') for cmd, count in self.command_totals.most_common(5)
+        )
+        
+        msg = ADMIN_TEMPLATE.format(
+            total_users=len(user_stats), new_today=new_today,
+            dau=dau, active_7d=active_7d, mau=mau, commands=commands
+        )
         await update.message.reply_text(msg, parse_mode='Markdown')
 
+    async def admin_dump(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Send the admin a pretty-printed JSON dump of all bot data"""
+        # Security Check: Only allow the admin defined in .env
+        if self.admin_id is None or update.effective_user.id != self.admin_id:
+            return  # Silent ignore (don't even reply to unauthorized users)
+        
+        # Stored data is compact; indentation is only paid for when someone reads it
+        dump = orjson.dumps({
+            'portfolios': portfolios,
+            'watchlists': watchlists,
+            'user_settings': user_settings,
+            'user_stats': user_stats
+        }, default=dump_default, option=ORJSON_OPTIONS | orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        await update.message.reply_document(
+            document=dump,
+            filename=f"paper_trading_dump_{datetime.now():%Y%m%d_%H%M%S}.json"
+        )
+
 def main():
     # Load environment variables
     load_dotenv()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s', level=logging.INFO)
+    logging.getLogger('httpx').setLevel(logging.WARNING)  # Don't log every Telegram poll
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     
     if not token:
-        print("Error: TELEGRAM_BOT_TOKEN not found in .env file")
+        log.error("Error: TELEGRAM_BOT_TOKEN not found in .env file")
         return
     
+    if uvloop:
+        # run_polling/run_webhook pick up the loop set here
+        asyncio.set_event_loop(uvloop.new_event_loop())
+    
     bot = PaperTradingBot()
-    app = Application.builder().token(token).build()
+    app = Application.builder().token(token).post_init(bot.post_init).post_shutdown(bot.post_shutdown).build()
     
     # Add command handlers
-    app.add_handler(CommandHandler("start", bot.start))
-    app.add_handler(CommandHandler("info", bot.info_command))
-    app.add_handler(CommandHandler("price", bot.get_price))
-    app.add_handler(CommandHandler("buy", bot.buy))
-    app.add_handler(CommandHandler("sell", bot.sell))
-    app.add_handler(CommandHandler("portfolio", bot.portfolio))
-    app.add_handler(CommandHandler("history", bot.history))
-    app.add_handler(CommandHandler("fund", bot.fund))
-    app.add_handler(CommandHandler("reset", bot.reset))
-    app.add_handler(CommandHandler("watch", bot.watch_command))
-    app.add_handler(CommandHandler("watchlist", bot.watchlist_command))
-    app.add_handler(CommandHandler("stats", bot.stats_command))
-    app.add_handler(CommandHandler("chart", bot.chart_command))
-    app.add_handler(CommandHandler("leaderboard", bot.leaderboard))
-    app.add_handler(CommandHandler("settings", bot.settings_command))
-    app.add_handler(CommandHandler("admin", bot.admin_stats))
+    commands = (
+        ("start", bot.start),
+        ("info", bot.info_command),
+        ("price", bot.get_price),
+        ("buy", bot.buy),
+        ("sell", bot.sell),
+        ("portfolio", bot.portfolio),
+        ("history", bot.history),
+        ("fund", bot.fund),
+        ("reset", bot.reset),
+        ("watch", bot.watch_command),
+        ("watchlist", bot.watchlist_command),
+        ("stats", bot.stats_command),
+        ("chart", bot.chart_command),
+        ("leaderboard", bot.leaderboard),
+        ("settings", bot.settings_command),
+        ("admin", bot.admin_stats),
+        ("admin_dump", bot.admin_dump)
+    )
+    for name, callback in commands:
+        app.add_handler(CommandHandler(name, callback))
     
     # Handle callback buttons
     app.add_handler(CallbackQueryHandler(bot.quick_buy_callback, pattern="^(qbuy|watch|refresh)_"))
     app.add_handler(CallbackQueryHandler(bot.position_actions, pattern="^pos_"))
-    app.add_handler(CallbackQueryHandler(bot.handle_position_actions, pattern="^(posrefresh|poschart|posbuy|possell)_"))
-    app.add_handler(CallbackQueryHandler(bot.handle_position_actions, pattern="^back_portfolio$"))
+    app.add_handler(CallbackQueryHandler(bot.handle_position_actions, pattern="^(?:(?:posrefresh|poschart|posbuy|possell)_|back_portfolio$)"))
     app.add_handler(CallbackQueryHandler(bot.handle_settings, pattern="^set_"))
     
     # Auto-detect pasted addresses
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_address_paste))
     
-    print("🤖 Bot started successfully!")
-    print("Go to Telegram and send /start to your bot")
-    app.run_polling()
+    log.info("🤖 Bot started successfully!")
+    log.info("Go to Telegram and send /start to your bot")
+    # Updates left over from while the bot was down would trade on stale prices
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        # Telegram pushes each update, nothing polls while the bot is idle
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", 8443)),
+            url_path=token,
+            webhook_url=f"{webhook_url.rstrip('/')}/{token}",
+            drop_pending_updates=True
+        )
+    else:
+        # Long polling: each getUpdates call waits up to 30s for new updates
+        app.run_polling(timeout=30, drop_pending_updates=True)
 
 if __name__ == '__main__':
     main()